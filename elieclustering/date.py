@@ -46,6 +46,9 @@ class DatePatterns(object):
 
     ### warning, altitude could be misinterpreted for years
 
+    # every date format includes a year, hence at least two consecutive digits
+    year_digits_pattern = regex.compile(r'[0-9]{2}')
+
     # separators can be the followings:
     separator_patterns = { 
         "set1"          :   r'(?:[:\|/.,]){i<=1,s<=1:\s}'}
@@ -150,7 +153,11 @@ class DatePatterns(object):
                 format or precision level.
         '''
         
+        # a text without year digits cannot match any of the date patterns
         hits = []
+        if self.year_digits_pattern.search(value) is None:
+            return hits
+
         for pattern, tags in self.get_patterns(**allow_tags):
             m = pattern.search(value)
             if m is None: continue
@@ -1237,6 +1244,10 @@ def tag_date_pattern(pattern, **other_tags):
     
     return DatePatternTags(**tags)
 
+# the date patterns are compiled the first time they are used, then shared by
+# all calls to find_date
+default_date_patterns = None
+
 def find_date(text, **allow_tags):
     '''
     Attempts to find a date in a given text.
@@ -1271,5 +1282,7 @@ def find_date(text, **allow_tags):
             Restrict the match to either a single date or a date range.
     '''
     
-    date_parser = DatePatterns(**allow_tags)
-    return date_parser.find_date(text, get_span=True)
+    global default_date_patterns
+    if default_date_patterns is None:
+        default_date_patterns = DatePatterns()
+    return default_date_patterns.find_date(text, get_span=True, **allow_tags)
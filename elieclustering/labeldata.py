@@ -2,10 +2,12 @@
 This module contains classes and functions to handle and integrate 
 information extracted from specimen labels. It allows to build 
 searchable text databases using token extraction and text feature 
-scoring. This module uses the packages regex, sklearn, nltk and leven.
+scoring. This module uses the packages regex, numpy, sklearn, nltk and
+leven.
 '''
 
 import json, elieclustering.date, regex, sys
+import numpy as np
 from nltk import regexp_tokenize
 from elieclustering.utils import (mismatch_rule, 
                         get_word_tokenize_pattern, 
@@ -13,7 +15,7 @@ from elieclustering.utils import (mismatch_rule,
                         get_norm_leven_dist)
 from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
 from leven import levenshtein
-from collections import defaultdict
+from collections import defaultdict, Counter
 
 # =============================================================================
 # CLASSES
@@ -24,6 +26,10 @@ class Label(object):
     '''
     
     keys = ("ID", "text")
+
+    # attribute values are stored in a single dict, labels have no other
+    # instance attribute
+    __slots__ = ("_data",)
     
     def __init__(self, ID=None, text=None):
         '''
@@ -86,6 +92,7 @@ class CollectingEvent(Label):
     ### and make a collecting event object from a label object
     
     keys = ("ID", "location", "date", "collector", "text")
+    __slots__ = ()
     
     def __init__(self, ID=None, location=None, date=None, collector=None, 
                  text=None):
@@ -248,6 +255,13 @@ class DB(object):
         
         self._dict = dict( (x.ID, x) for x in values )
         self._ids = list(self._dict.keys())    
+
+        # position of each element in the database, used in the index
+        self._values = list(self._dict.values())
+        self._positions = dict( (ID, i) for i, ID in enumerate(self._ids) )
+
+        # element texts, in the same order
+        self._texts = [ x.text for x in self._values ]
     
     @property
     def element_type(self):
@@ -277,6 +291,22 @@ class DB(object):
 
         return self._dict[value]
     
+    def get_ids(self):
+        '''
+        Returns a list of the IDs of the database elements, in the 
+        order of the database.
+        '''
+
+        return list(self._ids)
+
+    def get_texts(self):
+        '''
+        Returns a list of the texts of the database elements, in the 
+        order of the database.
+        '''
+
+        return list(self._texts)
+
     def is_indexed(self):
         '''
         Returns True if the class method make_index was called.
@@ -322,7 +352,10 @@ class DB(object):
         token_pattern = get_word_tokenize_pattern(min_len)
         
         # index and stored parameters
-        self._index = defaultdict(list)
+        self._index = dict()
+        self._item_tokens = defaultdict(set)
+        self._tokens_cache = dict()
+        self._matches_cache = dict()
         self._parameters = {"method": method, "token_pattern": token_pattern,
                             "keys": keys, "masks": masks}
         
@@ -344,19 +377,26 @@ class DB(object):
         
         # Store the matrix containing scores for each unique token in each
         # element of the database, then build the index linking tokens with
-        # items and scores.
+        # items and scores. Each token is linked with the sorted positions of
+        # the items that contain it (int32 array) and the corresponding 
+        # scores (float array), read from the columns of the matrix.
         corpus = self.get_corpus(keys=keys, masks=masks)
-        score_matrix = vectorizer.fit_transform(corpus)
+        score_matrix = vectorizer.fit_transform(corpus).tocsc()
+        score_matrix.eliminate_zeros()
+        score_matrix.sort_indices()
+        indptr = score_matrix.indptr
         item_scores = defaultdict(dict)
         for j, token in enumerate(vectorizer.get_feature_names_out().tolist()):
-            for i, x in enumerate(self):
-                score = score_matrix[i,j]
-                if score:
-                    self._index[token].append((x, score))
-                    item_scores[x.ID][token] = score
+            rows = score_matrix.indices[indptr[j]:indptr[j+1]].astype(np.int32)
+            scores = score_matrix.data[indptr[j]:indptr[j+1]]
+            self._index[token] = (rows, scores)
+            for i, score in zip(rows.tolist(), scores.tolist()):
+                ID = self._ids[i]
+                self._item_tokens[ID].add(token)
+                item_scores[ID][token] = score
         
         # compute maximum scores
-        self._max_scores = defaultdict(lambda: 0)
+        self._max_scores = defaultdict(int)
         for x in self:
             for token in self.get_item_tokens(x.ID):
                 self._max_scores[x.ID] += item_scores[x.ID][token]
@@ -373,8 +413,9 @@ class DB(object):
         # Numbers are converted to Python native float, for serialization purpose.
         # It may result in scoring imprecision when using a dumped database.
         index = dict( (token, 
-                      [ (x.ID, float(score)) for x, score in self._index[token] ])
-                      for token in self._index )
+                      [ (self._ids[i], score) 
+                         for i, score in zip(rows.tolist(), scores.tolist()) ])
+                      for token, (rows, scores) in self._index.items() )
         max_scores = dict( (ID, float(self._max_scores[ID]))
                             for ID in self._max_scores )
         json.dump({"index": index, 
@@ -388,16 +429,43 @@ class DB(object):
         '''
         
         data = json.load(f)
-        self._index = dict( (token,
-                             [ (self.get(ID), float(score)) for ID, score in data["index"][token] ])
-                             for token in data["index"] )
         self._parameters = data["parameters"]
         self._max_scores = data["max_scores"]
+        self._tokens_cache = dict()
+        self._matches_cache = dict()
+
+        # link tokens with sorted item positions and scores, and each item 
+        # with its indexed tokens
+        self._index = dict()
+        self._item_tokens = defaultdict(set)
+        for token, hits in data["index"].items():
+            hits = sorted( (self._positions[ID], float(score)) 
+                            for ID, score in hits )
+            rows = np.array([ i for i, score in hits ], dtype=np.int32)
+            scores = np.array([ score for i, score in hits ], dtype=float)
+            self._index[token] = (rows, scores)
+            for i, score in hits:
+                self._item_tokens[self._ids[i]].add(token)
+
+    def tokenize(self, text):
+        '''
+        Uses the parameters of the index to generate tokens from a 
+        text.
+
+        Parameters
+        ----------
+            text : str
+                Any text.
+        '''
+
+        return regexp_tokenize(strip_accents(text.lower()), 
+                               self._parameters["token_pattern"])
 
     def get_item_tokens(self, ID):
         '''
         Uses the parameters of the index to generate tokens for a given
-        item.
+        item. Tokens are computed once per item and returned in a new 
+        list.
 
         Parameters
         ----------
@@ -405,6 +473,12 @@ class DB(object):
                 Database item identifier
         '''
 
+        # tokens that were already computed
+        try:
+            return list(self._tokens_cache[ID])
+        except KeyError:
+            pass
+
         # make a list of keys (use index parameters)
         keys = self._parameters["keys"]
         if keys is None:
@@ -422,16 +496,32 @@ class DB(object):
         # identify the tokens
         x = self._dict[ID]
         tokens = []
-        pattern = self._parameters["token_pattern"]
         for key in keys:
             s = getattr(x, key)
             for mask in masks:
                 s = mask.mask(key, s)
-            tokens += regexp_tokenize(strip_accents(s.lower()), pattern)
+            tokens += self.tokenize(s)
+        self._tokens_cache[ID] = tuple(tokens)
         return tokens
 
+    def get_item_activity(self, ID):
+        '''
+        Returns the sum of the posting list lengths of the index tokens
+        found in a given item, i.e. the number of times the item shares
+        a token with an element of the database.
+
+        Parameters
+        ----------
+            ID : str
+                Database item identifier
+        '''
+
+        return sum( len(self._index[token][0]) 
+                     for token in self._item_tokens[ID] )
+
     def search(self, query, mismatch_rule=mismatch_rule, 
-               filtering=lambda x: True, scoring="w"):
+               filtering=None, scoring="w", candidates=None, 
+               query_tokens=None):
         '''
         Search elements of the database with the query text.
 
@@ -451,6 +541,21 @@ class DB(object):
                 returns True or False whether these elements have to be
                 kept in the final result of the search.
 
+            candidates : set|ndarray
+                If provided, limit the search to the elements whose ID
+                is in this set. Only the index tokens found in these
+                elements are searched, which is much faster than an 
+                equivalent filtering function when the set is small.
+                A mask of the database elements, as returned by the 
+                get_mask method, can be provided instead, which avoids
+                building it for each search when the same elements are
+                searched repeatedly.
+
+            query_tokens : list
+                The tokens of the query, as returned by the tokenize 
+                method, if they were already computed. By default, the
+                query is tokenized.
+
             scoring : str
                 Set up the scoring method.
                     "w" The score is calculated as the product of the 
@@ -474,9 +579,24 @@ class DB(object):
             raise ValueError("Database must be indexed with the 'make_index'"
                              " method prior to search")
         
+        # restrict the search to the tokens found in the candidates, which
+        # are flagged in a mask of the database elements
+        if candidates is None:
+            vocabulary = None
+        elif isinstance(candidates, np.ndarray):
+            if not candidates.any():
+                return []
+            vocabulary = None
+        elif not candidates:
+            return []
+        else:
+            vocabulary = set().union(*( self._item_tokens[ID] 
+                                         for ID in candidates ))
+            candidates = self.get_mask(candidates)
+
         # extract token from the query
-        query_tokens = regexp_tokenize(strip_accents(query.lower()), 
-                                       self._parameters["token_pattern"])
+        if query_tokens is None:
+            query_tokens = self.tokenize(query)
         
         # search database tokens with regular expression and score the possible 
         # matches
@@ -484,7 +604,8 @@ class DB(object):
 
         # build the token search function
         def search_tokens(q, mismatch_rule=mismatch_rule, filtering=filtering):
-            return self.get_token_matches(q, mismatch_rule, filtering).items()
+            return self.get_token_matches(q, mismatch_rule, filtering,
+                                          candidates, vocabulary).items()
 
         # search every token onto the database index
         for q in query_tokens:
@@ -502,19 +623,18 @@ class DB(object):
         # score matches while tracking tokens that were matched multiple times
         hit_scoring = defaultdict(lambda: [0, 0])
         for x_ID in matched_tokens:
-            subject_tokens = self.get_item_tokens(x_ID)
+            subject_tokens = Counter(self.get_item_tokens(x_ID))
             for token, identity, score in matched_tokens[x_ID]:
 
-                # consume matched tokens while scoring
-                try:
-                    subject_tokens.remove(token)
-
                 # if a subject token has already been scored, it means that it
                 # was matched by multiple query tokens and therefore needs to be
                 # ignored
-                except ValueError:
+                if not subject_tokens[token]:
                     continue
 
+                # consume matched tokens while scoring
+                subject_tokens[token] -= 1
+
                 # with the scoring method implying Levenshtein distance, do not 
                 # account for the identity as mismatches will be evaluated further
                 if scoring != "w":
@@ -566,7 +686,7 @@ class DB(object):
         return result      
             
     def get_token_matches(self, value, mismatch_rule=mismatch_rule, 
-                          filtering=lambda x: True):
+                          filtering=None, candidates=None, vocabulary=None):
         '''
         Find elements with matching tokens, return a list of IDs with 
         the associated token's TF-IDF score.
@@ -581,6 +701,17 @@ class DB(object):
                 single argument, the token, and return a fuzzy regular 
                 expression. If defined as None, it will look for exact 
                 matches.
+
+            filtering : function|None
+                A function that evaluates every matched element and
+                returns True or False whether it has to be kept.
+
+            candidates : ndarray|None
+                A mask of the database elements, as returned by the 
+                get_mask method. Only keep the flagged elements.
+
+            vocabulary : set|None
+                Only search the index tokens that are in this set.
         '''
         
         # matched tokens are listed for each database item
@@ -588,26 +719,42 @@ class DB(object):
 
         # retrieve matching tokens
         if mismatch_rule is None:
+            if vocabulary is not None and value not in vocabulary:
+                return dict()
             try:
-                for x, score in self._index[value]:
-                    if not filtering(x):
+                for x, score in self.get_postings(value, candidates):
+                    if filtering is not None and not filtering(x):
                         continue
                     result[x.ID].append((value, 1, score))
             except KeyError:
                 pass
         else:
-            pattern = regex.compile(fr"(?:{value}){mismatch_rule(value)}")
+            
+            # The index tokens matching the value, with their identity, do 
+            # not depend on the searched elements. They are only searched 
+            # once for each value and mismatch rule.
+            try:
+                matched = self._matches_cache[(value, mismatch_rule)]
+            except KeyError:
+                pattern = regex.compile(fr"(?:{value}){mismatch_rule(value)}")
+                matched = []
+                for token in self._index:
+                    m = pattern.fullmatch(token)
+                    if m is None: continue
+                    d = levenshtein(token, value)
+                    l = max((len(token), len(value)))
+                    identity = 0 if d > l else (1 - d/l)
+                    matched.append((token, identity))
+                self._matches_cache[(value, mismatch_rule)] = matched
             
             # list matching tokens in each database item x and associated 
             # scores
-            for token, hits in self._index.items():
-                m = pattern.fullmatch(token)
-                if m is None: continue
-                d = levenshtein(token, value)
-                l = max((len(token), len(value)))
-                identity = 0 if d > l else (1 - d/l)
-                for x, score in hits:
-                    if not filtering(x): continue
+            for token, identity in matched:
+                if vocabulary is not None and token not in vocabulary:
+                    continue
+                for x, score in self.get_postings(token, candidates):
+                    if filtering is not None and not filtering(x): 
+                        continue
                     result[x.ID].append((token, identity, score))
         
         # for each database item, only the best matched token is kept, ranked
@@ -619,6 +766,49 @@ class DB(object):
             
             for x_ID, matched_tokens in result.items() )
 
+    def get_positions(self, IDs):
+        '''
+        Returns an integer array containing the positions of the 
+        database elements whose ID is in the provided collection, which 
+        can be used to index a mask returned by the get_mask method.
+        '''
+
+        return np.fromiter(( self._positions[ID] for ID in IDs ), 
+                           dtype=np.intp, count=len(IDs))
+
+    def get_mask(self, IDs):
+        '''
+        Returns a boolean array flagging the database elements whose ID
+        is in the provided collection.
+        '''
+
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.get_positions(IDs)] = True
+        return mask
+
+    def get_postings(self, token, mask=None):
+        '''
+        Returns a list of the elements whose content includes the 
+        provided index token, along with the token score.
+
+        Parameters
+        ----------
+            token : str
+                A token of the index.
+            
+            mask : ndarray|None
+                A mask of the database elements, as returned by the 
+                get_mask method. Only returns the flagged elements.
+        '''
+
+        rows, scores = self._index[token]
+        if mask is not None:
+            keep = mask[rows]
+            rows, scores = rows[keep], scores[keep]
+        values = self._values
+        return [ (values[i], score) 
+                  for i, score in zip(rows.tolist(), scores.tolist()) ]
+
     def get_corpus(self, keys=None, masks=None, join="\n"):
         '''
         Returns a generator function that yields text values of the 
@@ -689,7 +879,7 @@ class DB(object):
         Iterate over elements of the database.
         '''
         
-        return iter( self._dict[key] for key in self._dict )
+        return iter(self._values)
 
 class LabelDB(DB):
     '''
@@ -864,31 +1054,38 @@ def parse_json_db(f):
     contains a JSON label or collecting event database.
     '''
 
-    # each label is comprised within curly brackets, there are no nested
-    # brackets
-    s, on = "", False
+    # Each element is a JSON object found within the top-level list(s). The
+    # objects are decoded straight from the buffered text as soon as they are
+    # complete, which avoids tracking curly brackets by hand (they can occur
+    # in the text values) and rebuilding the object strings.
+    decoder = json.JSONDecoder()
+    buffer = ""
     for line in f:
-        start, end = line.find("{"), line.find("}")
-        if start == -1:
-            if on: 
-                s += line[:end]
-                if end > -1:
-                    yield json.loads("{"+s+"}")
-                    s, on = "", False
-            elif end > -1:
-                raise ValueError("Input format error: nested curly brackets"
-                                 " found")
-        else:
-            if on:
-                raise ValueError("Input format error: nested curly brackets"
-                                 " found")
-            end = line.find("}")
-            s += line[start+1:end]
-            if end == -1:
-                on = True
-            else:
-                yield json.loads("{"+s+"}")
-                s, on = "", False
+        buffer += line
+
+        # an object can only be complete on a line that closes a bracket
+        if "}" not in line:
+            continue
+        pos = 0
+        while True:
+
+            # skip list delimiters and white spaces
+            start = buffer.find("{", pos)
+            if start == -1:
+                buffer = ""
+                break
+            try:
+                x, pos = decoder.raw_decode(buffer, start)
+
+            # the object is not complete yet, wait for the next lines
+            except json.JSONDecodeError:
+                buffer = buffer[start:]
+                break
+            yield x
+
+    # remaining object that could not be decoded
+    if "{" in buffer:
+        raise ValueError("Input format error: incomplete JSON object found")
 
 def parse_labels(f):
     '''
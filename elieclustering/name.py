@@ -8,10 +8,30 @@ import regex, json
 from elieclustering.utils import mismatch_rule, overlap, simplify_str, strip_accents
 from nltk import regexp_tokenize
 from functools import partial
+from operator import itemgetter
 
 # =============================================================================
 # CLASSES
 # -----------------------------------------------------------------------------
+class FuzzyPatternCache(dict):
+    '''
+    Compiled fuzzy patterns matching a name as a whole word, keyed on
+    the name, the mismatch rule and whether dots in the name only match
+    literal dots. Each pattern is compiled the first time it is 
+    requested, then reused for every searched text.
+    '''
+
+    def __missing__(self, key):
+        name, mismatch_rule, escape_dots = key
+        if escape_dots:
+            name_regex = r"\b" + name.replace(".", r"\.") + r"\b"
+        else:
+            name_regex = r"\b" + name + r"\b"
+        value = regex.compile(name_regex + mismatch_rule(name), 
+                              regex.BESTMATCH | regex.V1 | regex.M)
+        self[key] = value
+        return value
+
 class Collector(object):
     '''
     Store the name of a collector or an entity.
@@ -172,6 +192,11 @@ class Collector(object):
     def __repr__(self):
         return f'Collector({self.text})'
 
+fuzzy_patterns = FuzzyPatternCache()
+
+# =============================================================================
+# FUNCTIONS
+# -----------------------------------------------------------------------------
 def abbreviate_name(s, dots=False):
     '''
     Returns the first letter of each element of the input name. 
@@ -242,10 +267,7 @@ def search_collectors_regex(s, collectors, mismatch_rule=mismatch_rule,
             name = collector.simple_name
         else:
             name = collector.name
-        name_regex = r"\b" + name + r"\b"
-        p = regex.compile(name_regex + mismatch_rule(name), 
-                          regex.BESTMATCH | regex.V1 | regex.M)
-        m = p.search(target)
+        m = fuzzy_patterns[name, mismatch_rule, False].search(target)
         if m is not None:
             mismatches = sum(m.fuzzy_counts)
             score = (len(name)-mismatches)/len(name)
@@ -256,10 +278,7 @@ def search_collectors_regex(s, collectors, mismatch_rule=mismatch_rule,
     for m, collector, score in surname_matches:
         matches = []
         for name, format in collector.all_formats(ignore_case, simplified_str):
-            name_regex = r"\b" + name.replace(".", r"\.") + r"\b"
-            p = regex.compile(name_regex + mismatch_rule(name), 
-                              regex.BESTMATCH | regex.V1 | regex.M)
-            m = p.search(target)
+            m = fuzzy_patterns[name, mismatch_rule, True].search(target)
             if m is not None:
                 mismatches = sum(m.fuzzy_counts)
                 score = (len(name)-mismatches)/len(name)
@@ -267,8 +286,7 @@ def search_collectors_regex(s, collectors, mismatch_rule=mismatch_rule,
         
         # record the best match
         if matches:
-            matches.sort(key=lambda x: x[1], reverse=True)
-            fullname_matches.append(matches[0])
+            fullname_matches.append(max(matches, key=itemgetter(1)))
         else:
             fullname_matches.append((None, 0))
     
@@ -23,6 +23,10 @@ OPTIONS
         Limit text search in the collecting events to the provided 
         fields. By default, search only in the field "text".
 
+    -j, --jobs=INT
+        Number of processes used to search labels in parallel. 
+        Default = 1.
+
     -m, --method=METHOD
         Provide with the search method to use.
 
@@ -72,7 +76,12 @@ OPTIONS
 
 import sys, getopt, fileinput
 import elieclustering.date, elieclustering.labeldata, elieclustering.utils
+import numpy as np
 from math import log
+from contextlib import nullcontext
+
+# size of the buffer used to write the results (bytes)
+OUTPUT_BUFFER_SIZE = 1 << 20
 
 class Options(dict):
 
@@ -84,8 +93,9 @@ class Options(dict):
         # handle options with getopt
         try:
             opts, args = getopt.getopt(argv[1:],
-                                       "di:f:m:pus:x", 
+                                       "di:f:j:m:pus:x", 
                                        ['date-search',
+                                        'jobs=',
                                         'method=',
                                         'text-fields=',
                                         'persist',
@@ -112,6 +122,8 @@ class Options(dict):
                     notvalid = ', '.join( repr(x) for x in notvalid )
                     raise ValueError("The following keys are not valid:"
                                     f" {notvalid}.")
+            elif o in ('-j', '--jobs'):
+                self["jobs"] = int(a)
             elif o in ('-m', '--method'):
                 self["method"] = int(a)
             elif o in ('-p', '--persist'):
@@ -131,6 +143,7 @@ class Options(dict):
     
         # default parameter value
         self['date_search'] = False
+        self["jobs"] = 1
         self["method"] = 1
         self["persist"] = False
         self["scoring"] = "w"
@@ -138,6 +151,29 @@ class Options(dict):
         self["text_search"] = True
         self["unmatched_logs"] = False
     
+def get_fields_formatter(fields, sep="\t"):
+    '''
+    Returns a function that joins the values of the provided fields from
+    a dict object. The "text" values are written with their 
+    representation and missing values are written as empty strings.
+    '''
+
+    # the field specification is read only once
+    formatters = [ (field, field == "text") for field in fields ]
+    
+    def f(x):
+        values = []
+        for field, is_text in formatters:
+            value = x[field]
+            if value is None:
+                values.append("")
+            elif is_text:
+                values.append(repr(value))
+            else:
+                values.append(value)
+        return sep.join(values)
+    return f
+
 def write_results(fout, matches, query_fields=[], subject_fields=[], sep="\t", 
                   header=False):
     if header:
@@ -146,22 +182,107 @@ def write_results(fout, matches, query_fields=[], subject_fields=[], sep="\t",
         fout.write(f"{query_field_names}"
                    f"\t{subject_field_names}"
                     "\tscore\n")
-                   
+
+    # rows are accumulated and written at once
+    format_query = get_fields_formatter(query_fields, sep)
+    format_subject = get_fields_formatter(subject_fields, sep)
+    rows = []
+    last_label = None
     for label, hit, score in matches:
-        query_field_values = sep.join( (repr(label[field])
-                                         if field == "text"
-                                         else label[field])
-                                        if label[field] is not None else ""
-                                        for field in query_fields )
-        subject_field_values = sep.join( (repr(hit[field])
-                                           if field == "text"
-                                           else hit[field])
-                                          if hit[field] is not None else ""
-                                          for field in subject_fields )
-
-        fout.write(f"{query_field_values}"
-                   f"\t{subject_field_values}"
-                   f"\t{score:.3f}\n")
+
+        # consecutive matches of the same query are only formatted once
+        if label is not last_label:
+            query_field_values = format_query(label)
+            last_label = label
+        subject_field_values = format_subject(hit)
+        rows.append(f"{query_field_values}"
+                    f"\t{subject_field_values}"
+                    f"\t{score:.3f}\n")
+    fout.write("".join(rows))
+
+def open_output(buffer_size=OUTPUT_BUFFER_SIZE):
+    '''
+    Returns a text file that writes in the standard output through a 
+    buffer of the provided size (in bytes), to be used in a with 
+    statement. The standard output itself is left open. If it is not a
+    file (e.g. captured output), it is returned as is.
+    '''
+
+    try:
+        fileno = sys.stdout.fileno()
+    except (AttributeError, OSError, ValueError):
+        return nullcontext(sys.stdout)
+    sys.stdout.flush()
+    return open(fileno, "w", buffering=buffer_size, 
+                encoding=sys.stdout.encoding, errors=sys.stdout.errors,
+                closefd=False)
+
+def get_label_searcher(db, options):
+    '''
+    Returns a function that searches the collecting events matching a
+    label, according to the search options. This function returns a 
+    list of collecting events along with their hit score.
+    '''
+
+    # options and functions used for each label are only looked up once
+    date_search = options["date_search"]
+    text_search = options["text_search"]
+    persist = options["persist"]
+    scoring = options["scoring"]
+    mismatch_rule = elieclustering.utils.mismatch_rule
+    find_date = elieclustering.date.find_date
+    search, search_by_date, tokenize = db.search, db.search_by_date, db.tokenize
+
+    def f(label):
+        text = label.text
+
+        # search
+        hits = []
+        
+        # - by date, the text search is then limited to the collecting  
+        #   events with overlapping dates
+        date, candidates = None, None
+        if date_search:
+            date, _ = find_date(text)
+            if date is not None:
+                hits = search_by_date(date, assume_same_century=True)
+                candidates = { ce.ID for ce in hits }
+        
+        # - by text
+        if text_search:
+            tokens = tokenize(text)
+            hits = search(text, 
+                          mismatch_rule=mismatch_rule, 
+                          candidates=candidates,
+                          scoring=scoring,
+                          query_tokens=tokens)
+
+            # try on the whole database if --persist option was set
+            if persist and date is not None and not hits:
+                hits = search(text, 
+                              mismatch_rule=mismatch_rule, 
+                              scoring=scoring,
+                              query_tokens=tokens)
+        return hits
+    return f
+
+def init_search_worker(db, options):
+    '''
+    Build the label search function from the collecting event database
+    and the search options in a worker process.
+    '''
+
+    global search_label
+    search_label = get_label_searcher(db, options)
+
+def search_label_worker(label):
+    '''
+    Search the provided label within a worker process. Collecting 
+    events are returned as IDs, to be retrieved in the main process.
+    '''
+
+    hits = search_label(label)
+    return (label, [ (ce.ID, score) for ce, score in hits ])
 
 def main(argv=sys.argv):
     
@@ -184,72 +305,72 @@ def main(argv=sys.argv):
     # build the date index
     db.make_date_index()
         
-    # print the header for the result table
-    write_results(sys.stdout, [], 
-                   ["label.ID", "label.text"], 
-                   ["CE.ID", "CE.location", "CE.date", "CE.collector", 
-                    "CE.text"],
-                   header = True)
-    
-    # save unmatched labels and unmatched collecting events
-    unmatched_ce = { ce.ID for ce in db }
+    # save unmatched labels and unmatched collecting events, the latter are
+    # flagged in a mask of the database elements
+    unmatched_ce = np.ones(len(db), dtype=bool)
     unmatched_labels = set()
     
     # read label text that is stored in one or several JSON input 
     # files
-    for label in elieclustering.labeldata.parse_labels(fileinput.input()):
+    labels = elieclustering.labeldata.parse_labels(fileinput.input())
 
-        # search
-        hits = []
-        
-        # - by date
-        if options["date_search"]:
-            date, _ = elieclustering.date.find_date(label.text)
-            if date is None:
-                filtering = lambda ce: True
-            else:
-                hits = db.search_by_date(date, assume_same_century=True)
-                ids = set( ce.ID for ce in hits )
-                filtering = lambda ce: ce.ID in ids
-        else:
-            filtering = lambda ce: True
-            date = None
-        
-        # - by text
-        if options["text_search"]:
-            hits = db.search(label.text, 
-                             mismatch_rule=elieclustering.utils.mismatch_rule, 
-                             filtering=filtering,
-                             scoring=options["scoring"])
+    # Labels are searched independently, either sequentially or by a pool
+    # of worker processes. In the latter case, results are retrieved in the 
+    # input order.
+    if options["jobs"] > 1:
+        pool = elieclustering.utils.get_worker_pool(options["jobs"], 
+                                                    init_search_worker, 
+                                                    (db, options))
+        results = ( (label, [ (db.get(ID), score) for ID, score in hits ])
+                     for label, hits in pool.imap(search_label_worker, 
+                                                  labels, chunksize=64) )
+    else:
+        pool = None
+        search = get_label_searcher(db, options)
+        results = ( (label, search(label)) 
+                     for label in labels )
 
-            # try on the whole database if --persist option was set
-            if all((options["persist"], options["date_search"], 
-                    date is not None, not hits)):
-                hits = db.search(label.text, 
-                                 mismatch_rule=elieclustering.utils.mismatch_rule, 
-                                 filtering=lambda ce: True,
-                                 scoring=options["scoring"])
+    try:
+        # results are written in the standard output through a large buffer, 
+        # which is flushed when leaving the with statement, even on error
+        with open_output() as fout:
+
+            # print the header for the result table
+            write_results(fout, [], 
+                           ["label.ID", "label.text"], 
+                           ["CE.ID", "CE.location", "CE.date", "CE.collector", 
+                            "CE.text"],
+                           header = True)
+
+            for label, hits in results:
         
-        # save labels that did not match any collecting events
-        if not hits:
-            unmatched_labels.add(label.ID)
+                # save labels that did not match any collecting events
+                if not hits:
+                    unmatched_labels.add(label.ID)
         
-        # remove matched collecting from the set of unmatched 
-        # collecting events
-        for ce, score in hits:
-            try:
-                unmatched_ce.remove(ce.ID)
-            except KeyError:
-                pass
+                # remove matched collecting from the set of unmatched 
+                # collecting events
+                matched_ids = [ ce.ID for ce, score in hits ]
+                unmatched_ce[db.get_positions(matched_ids)] = False
         
-        # print the result
-        matches = ( (label.export(), ce.export(), score) 
-                        for ce, score in hits )
-        write_results(sys.stdout, matches, 
-                        ["ID", "text"],
-                        ["ID", "location", "date", "collector", "text"])
-                
+                # print the result
+                label_data = label.export()
+                matches = [ (label_data, ce.export(), score) for ce, score in hits ]
+                write_results(fout, matches, 
+                                ["ID", "text"],
+                                ["ID", "location", "date", "collector", "text"])
+
+    finally:
+
+        # stop the worker processes, even if the search or the output failed
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
     # print the unmatched item log
+    unmatched_ce = [ ID 
+                      for ID, flag in zip(db.get_ids(), unmatched_ce.tolist()) 
+                      if flag ]
     if options["unmatched_logs"]:
         with open("__unmatched_labels.txt", "w") as fout:
             fout.writelines( f"{ID}\n" for ID in unmatched_labels )
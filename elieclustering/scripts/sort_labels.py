@@ -24,6 +24,19 @@ DESCRIPTION
         4) Stop if the unsorted label collection is empty, otherwise
            go back to step 1.
     
+    With option --popular-first, step 1 picks the unsorted label whose 
+    words are shared by the largest number of labels instead of a 
+    random one, so that large groups are formed first. Otherwise, the
+    random sampling can be made reproducible with option --random-seed.
+
+    With option -l, groups are instead formed by single linkage: every
+    label is searched against all the others, and labels are put in 
+    the same group when they are connected by a chain of matches whose
+    similarity values are greater than the threshold. Groups do not 
+    depend on the order in which labels are picked, and the searches
+    can be run in parallel (option -j), but they can be larger than the
+    groups found from seed labels.
+
     With option -r, the sorted groups are subclustered using the
     K-medoids method based on pairwise Levenshtein distance. To avoid 
     overclustering, it is therefore advised to use a low similarity 
@@ -47,6 +60,12 @@ OPTIONS
         
     -d, --date
         Attempt to identify a date pattern.
+
+    --early-stop
+        With option -r, stop evaluating larger cluster numbers once 
+        the same elbow was found three times in a row on the SSE 
+        curve. Faster, but the selected cluster number can differ from
+        the one found on the complete curve.
         
     -f, --id-format=FORMAT
         Define the format of the identifiers attributed to each group 
@@ -59,6 +78,16 @@ OPTIONS
    
     -g, --geo
         Attempt to identify a geolocalization.
+
+    -j, --jobs=INT
+        Number of processes used to subcluster groups and parse their
+        labels in parallel (groups are still found sequentially, except
+        with option -l, where searches are run in parallel as well), or
+        with option -p, to parse labels in parallel. Default = 1.
+
+    -l, --single-linkage
+        Form groups by single linkage (see Clustering) instead of 
+        searching from seed labels.
     
     -m, --min-length=INT
         Minimum word length to be included in the search index. 
@@ -69,6 +98,15 @@ OPTIONS
         together, parse information first, then aggregate labels with
         the same parsed information.
 
+    --popular-first
+        Pick seed labels by decreasing number of index words shared
+        with other labels, instead of randomly.
+
+    --random-seed=INT
+        Seed of the random sampling of seed labels, so that the same
+        groups are found when the command is run again on the same 
+        input. By default, the groups differ from one run to another.
+
     -q, --consensus-quorum=INT
         Apply the consensus method only if the number of label in the 
         analyzed cluster is greater than the provided value. Default=2.
@@ -104,12 +142,18 @@ OPTIONS
         Display this message
 '''
 
-import getopt, sys, json, fileinput, regex
+import getopt, sys, fileinput, warnings
 import elieclustering.date, elieclustering.labeldata, elieclustering.geo, elieclustering.name, elieclustering.utils
 import numpy as np
-from io import StringIO
-from random import randrange
+from random import Random
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from functools import partial
+from operator import itemgetter
+from collections import defaultdict
+
+# number of result lines gathered before being written at once
+WRITE_BATCH_SIZE = 1024
 
 class Options(dict):
 
@@ -121,10 +165,15 @@ class Options(dict):
         # handle options with getopt
         try:
             opts, args = getopt.getopt(argv[1:], 
-                                       "c:df:gm:rs:v:qp", 
-                                       ['collector=', 'date', 'id-format=', 
-                                        'geo', 'min-length=', 'min-score=', 
-                                        'refine', 'consensus=', 'parse-and-sort=',
+                                       "c:df:gj:lm:rs:v:qp", 
+                                       ['collector=', 'date',
+                                        'early-stop',
+                                        'id-format=', 
+                                        'geo', 'jobs=', 'single-linkage',
+                                        'min-length=', 'min-score=', 
+                                        'popular-first', 'random-seed=',
+                                        'refine', 
+                                        'consensus=', 'parse-and-sort=',
                                         'consensus-quorum=', 'help'])
         except getopt.GetoptError as e:
             sys.stderr.write(str(e) + '\n' + __doc__)
@@ -138,12 +187,22 @@ class Options(dict):
                 self["collector"] = a
             elif o in ('-d', '--date'):
                 self["date"] = True
+            elif o == '--early-stop':
+                self["early_stop"] = True
             elif o in ('-f', '--id-format'):
                 self["id_formatter"] = elieclustering.utils.get_id_formatter(a)
             elif o in ('-g', '--geo'):
                 self["geo"] = True
+            elif o in ('-j', '--jobs'):
+                self["jobs"] = int(a)
+            elif o in ('-l', '--single-linkage'):
+                self["single_linkage"] = True
             elif o in ('-m', '--min-length'):
                 self["min_word_length"] = int(a)
+            elif o == '--popular-first':
+                self["popular_first"] = True
+            elif o == '--random-seed':
+                self["random_seed"] = int(a)
             elif o in ('-r', '--refine'):
                 self["refine"] = True
             elif o in ('-s', '--min-score'):
@@ -162,10 +221,15 @@ class Options(dict):
         # default parameter value
         self["collector"] = None
         self['date'] = False
+        self["early_stop"] = False
         self["id_formatter"] = elieclustering.utils.get_id_formatter("label:5")
         self["geo"] = False   
+        self["jobs"] = 1
+        self["single_linkage"] = False
         self["min_word_length"] = 3
         self["min_score"] = 0.8
+        self["popular_first"] = False
+        self["random_seed"] = None
         self["refine"] = False
         self["consensus"] = None
         self["quorum"] = 2
@@ -223,10 +287,10 @@ def parse_names(text, collectors):
         results.append((matched_str, span, namestr))
     return results
 
-def refine(labels, dist=None, get_median_dist=False):
+def refine(labels, dist=None, get_median_dist=False, early_stop=False):
     '''
     Identify K-medoids within a group of labels. Does not do anything
-    if there are less than 4 elements.
+    if there are less than 8 elements.
 
     Parameters
     ----------
@@ -243,6 +307,10 @@ def refine(labels, dist=None, get_median_dist=False):
         get_median_dist : bool
             Output each label along with its median distance with 
             other labels in the same cluster.
+
+        early_stop : bool
+            Stop the evaluation of cluster numbers early, see 
+            elieclustering.utils.find_levenKMedoids.
     '''
 
     # list input
@@ -252,18 +320,19 @@ def refine(labels, dist=None, get_median_dist=False):
     lines = [ label.text for label in labels ]
     n = len(lines)
 
+    # does not attempt anything for less than 8 elements, the distance matrix
+    # is not needed unless median distances are requested
+    if n < 8 and not get_median_dist:
+        return [labels]
+
     # calculates the pairwise distance matrix
     if dist is None:
         dist = elieclustering.utils.get_pairwise_leven_dist(lines, simplify=True)
 
-    # does not attempt anything for less than 8 elements
+    # with less than 8 elements, only get median distance for each point
     if n < 8:
-
-        # get median distance for each point
-        if get_median_dist:
-            margin_medians = elieclustering.utils.get_median_dists(dist)
-            labels = list(zip(labels, margin_medians))
-        return [labels]
+        margin_medians = elieclustering.utils.get_median_dists(dist)
+        return [list(zip(labels, margin_medians))]
         
     # the maximum number of cluster to evaluate is 20, or the number of
     # elements divided by 2.
@@ -273,8 +342,12 @@ def refine(labels, dist=None, get_median_dist=False):
         max_cluster = 20
     
     # attempt to optimise clustering using the knee selection method on the SSE 
-    # values
-    kmedoids = elieclustering.utils.find_levenKMedoids(dist, max_cluster=max_cluster)
+    # values; single precision is enough for normalized distances and halves
+    # the memory traffic during the medoid swaps
+    kmedoids = elieclustering.utils.find_levenKMedoids(dist.astype(np.float32,
+                                                                   copy=False), 
+                                                       max_cluster=max_cluster,
+                                                       early_stop=early_stop)
     
     # if the cluster identification failed with this method, do not cluster
     if kmedoids is None:
@@ -297,15 +370,22 @@ def refine(labels, dist=None, get_median_dist=False):
             clusters[cluster_index] = [label]
             index_map[cluster_index] = [label_index]
     
-    # calculate median distances within each subcluster
+    # calculate median distances within each subcluster at once, by masking
+    # the distances between labels of different subclusters and the diagonal
+    # (single label subclusters have no median distance: NaN)
     if get_median_dist:
+        cluster_indexes = np.asarray(kmedoids.labels_)
+        same_cluster = cluster_indexes[:,None] == cluster_indexes[None,:]
+        np.fill_diagonal(same_cluster, False)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            subdist_medians = np.nanmedian(np.where(same_cluster, dist, 
+                                                    np.nan), 
+                                           axis=1)
         for cluster_index in index_map:
-            indexes = np.array(index_map[cluster_index])
-            rows, cols = indexes[:,None], indexes[None,:]
-            subdist = dist[rows, cols]
-            subdist_median = elieclustering.utils.get_median_dists(subdist)
+            medians = subdist_medians[index_map[cluster_index]]
             clusters[cluster_index] = list(zip(clusters[cluster_index], 
-                                               subdist_median))
+                                               medians))
 
     # return a list of lists containing labels from the same cluster
     return list(clusters.values())
@@ -331,9 +411,6 @@ def parse_info(text, geo=False, date=False, collectors=[]):
             }
         } 
     
-    # text segment breaks
-    segments = []
-    
     # parse the text to retrieve date information, then remove
     # the intepreted text.
     if date:
@@ -341,18 +418,23 @@ def parse_info(text, geo=False, date=False, collectors=[]):
         if span != -1: text = elieclustering.utils.clear_text(text, span)
         found_info["date"]["verbatim"] = verbatim
         found_info["date"]["interpreted"] = interpreted
-        if span != -1:
-            segments += list(span)
     
     # parse the text to retrieve the collector name
     if collectors:
         interpreted = []
         verbatim = []
         hits = elieclustering.name.find_collectors(text, collectors)
-        for collector, span, score in hits:
-            interpreted.append(collector.text)
-            verbatim.append(text[slice(*span)])
-            text = elieclustering.utils.clear_text(text, span)
+
+        # matches are cleared in a list of characters, like clear_text would
+        # do, and the text is only rebuilt once
+        if hits:
+            chars = list(text)
+            for collector, span, score in hits:
+                start, end = span
+                interpreted.append(collector.text)
+                verbatim.append("".join(chars[start:end]))
+                chars[start:end+1] = " "*(end-start+1)
+            text = "".join(chars)
         interpreted = ", ".join(interpreted)
         verbatim = "|".join(verbatim)
         found_info["collectors"]["verbatim"] = verbatim
@@ -365,8 +447,6 @@ def parse_info(text, geo=False, date=False, collectors=[]):
         if span != -1: text = elieclustering.utils.clear_text(text, span)
         found_info["geo"]["verbatim"] = verbatim
         found_info["geo"]["interpreted"] = interpreted
-        if span != -1:
-            segments += list(span)
     
     return found_info
 
@@ -383,114 +463,390 @@ def format_result_line(label, group_id, found_info,
                        fields=("geo", "date", "collectors"),
                        consensus_text=None):
 
-    line = f'{label.ID}\t{repr(label.text)}\t{group_id}'
+    line = f'{label.ID}\t{label.text!r}\t{group_id}'
     for field in fields:
-        if found_info[field]["interpreted"]:
-            line += (f'\t{found_info[field]["verbatim"]}'
-                     f'\t{found_info[field]["interpreted"]}')
+        info = found_info[field]
+        if info["interpreted"]:
+            line += f'\t{info["verbatim"]}\t{info["interpreted"]}'
     if consensus_text is not None:
         line += f'\t{consensus_text}'
     return line + "\n"
 
-def sort_by_text_similarity(db, parse_info, format_result_line, consensus=None,
-                            min_score=0.8, refine_clustering=False, 
-                            id_formatter=elieclustering.utils.get_id_formatter("label:5"),
-                            quorum=2):
+def get_group_processor(parse_info, consensus=None, refine_clustering=False,
+                        quorum=2, early_stop=False):
     '''
-    Aggregate labels by text similarity, then parse information within 
-    label groups.
+    Return a function that takes a group of labels matched by text 
+    similarity, splits it into clusters and parses information within
+    each cluster. The function returns a list of tuples containing the
+    labels of a cluster, the information found for each of these labels
+    and the consensus text (None if no consensus was built).
     '''
 
     # consensus method to be used
     if consensus == "alignment":
-        consensus = True
         get_consensus = elieclustering.utils.text_alignment_consensus
     elif consensus == "pick":
-        consensus = True
         get_consensus = elieclustering.utils.text_pick_consensus
     else:
-        consensus = False
+        get_consensus = None
 
-    # label to be classified
-    to_be_sorted = [ label.ID for label in db ]
+    # with the "pick" method, the median distances of the labels are taken 
+    # from the distance matrix used to find the K-medoids, rather than 
+    # calculated again for each cluster
+    reuse_dist = refine_clustering and consensus == "pick"
+
+    def f(matches):
+
+        # find K-medoids within the matched labels, median distances are only
+        # needed if a consensus can be built (a single label has none)
+        get_median_dist = reuse_dist and len(matches) >= max(2, quorum)
+        if refine_clustering:
+            clusters = refine(matches, get_median_dist=get_median_dist,
+                              early_stop=early_stop)
+        else:
+            clusters = [matches]
+        
+        results = []
+        for cluster in clusters:
+            if get_median_dist:
+                cluster, median_dists = zip(*cluster)
+                cluster = list(cluster)
+
+            # if the consensus option is selected and the cluster reaches the 
+            # quorum, information is parsed within the consensus text instead
+            # of within each individual label
+            consensus_text = None
+            if get_consensus is not None and len(cluster) >= quorum:
+                if get_median_dist:
+                    label, median_dist = min(zip(cluster, median_dists), 
+                                             key=itemgetter(1))
+                    consensus_text = elieclustering.utils.simplify_str(
+                        label.text)
+                else:
+                    consensus_text = get_consensus([ label.text
+                                                      for label in cluster ], 
+                                                   simplify=True)
+                found_infos = [parse_info(consensus_text)]*len(cluster)
+
+            # otherwise parse info from each individual label
+            else:
+                found_infos = [ parse_info(label.text) for label in cluster ]
+            results.append((cluster, found_infos, consensus_text))
+        return results
+    return f
+
+def init_group_worker(parse_info, consensus, refine_clustering, quorum, 
+                      early_stop):
+    '''
+    Build the group processing function in a worker process.
+    '''
+
+    global process_group
+    process_group = get_group_processor(parse_info, consensus=consensus,
+                                        refine_clustering=refine_clustering,
+                                        quorum=quorum, early_stop=early_stop)
+
+def process_group_worker(matches):
+    '''
+    Process a group of labels within a worker process.
+    '''
+
+    return process_group(matches)
+
+def iter_similarity_groups(db, min_score=0.8, popular_first=False,
+                           random_seed=None):
+    '''
+    Aggregate labels by text similarity. Yields each group of labels as
+    a list, and removes its labels from the labels to be sorted. Seed 
+    labels are sampled randomly (reproducibly if random_seed is set), or
+    with popular_first, by decreasing activity in the index (see 
+    DB.get_item_activity).
+    '''
+
+    # random number generator, local to this run
+    randrange = Random(random_seed).randrange
+
+    # label to be classified: the set allows fast membership tests, while the
+    # list allows sampling. IDs removed from the set are only discarded from 
+    # the list when they are sampled.
+    to_be_sorted_list = db.get_ids()
+    to_be_sorted = set(to_be_sorted_list)
+
+    # the most active labels are placed at the end of the list, to be sampled
+    # first
+    if popular_first:
+        to_be_sorted_list.sort(key=db.get_item_activity)
+
+    # the same labels are flagged in a mask of the database elements, which
+    # restricts the searches without being rebuilt for each of them
+    to_be_sorted_mask = np.ones(len(db), dtype=bool)
+
+    # number of index tokens in each label, to exclude labels with too few
+    # tokens from the searches
+    token_counts = get_token_counts(db)
 
-    # label group number
-    i = 0
-    
     # Successively, sample a label, finds matching labels in the database, 
     # attribute these labels to a group and remove these labels from the labels
     # to be sorted
     while to_be_sorted:
-        seed_id = to_be_sorted.pop(randrange(len(to_be_sorted)))
+
+        # sample an ID (the last one, or a random one), swap it with the last
+        # one of the list and pop it, until it is one that still has to be 
+        # sorted
+        while True:
+            if popular_first:
+                k = len(to_be_sorted_list)-1
+            else:
+                k = randrange(len(to_be_sorted_list))
+            seed_id = to_be_sorted_list[k]
+            to_be_sorted_list[k] = to_be_sorted_list[-1]
+            to_be_sorted_list.pop()
+            if seed_id in to_be_sorted:
+                break
+        to_be_sorted.remove(seed_id)
+        to_be_sorted_mask[db.get_positions([seed_id])] = False
         seed_label = db.get(seed_id)
         seed_text = seed_label.text
-        filtering = lambda x: x.ID in to_be_sorted
+
+        # the index is built on the label text only, so the seed tokens are
+        # those already computed for the seed label
+        seed_tokens = db.get_item_tokens(seed_id)
+        min_tokens = min_score*len(seed_tokens) - 1e-9
+        candidates = to_be_sorted_mask & (token_counts >= min_tokens)
         matches = [ label 
                      for label, score in db.search(seed_text, 
-                                                   filtering=filtering) 
+                                                   candidates=candidates,
+                                                   query_tokens=seed_tokens) 
                      if score >= min_score ]
         matches.append(seed_label)
-        
-        # find K-medoids within the matched labels
-        if refine_clustering:
-            clusters = refine(matches)
-        else:
-            clusters = [matches]
-        
-        # print the result
-        for cluster in clusters:
-            i += 1
-            group_id = id_formatter(i)
 
-            # if the consensus option is selected and the cluster reaches the 
-            # quorum, information is parsed within the consensus text instead
-            # of within each individual label
-            consensus_text = None
-            if consensus and len(cluster) >= quorum:
-                consensus_text = get_consensus([ label.text
-                                                  for label in cluster ], 
-                                               simplify=True)
-                found_info = parse_info(consensus_text)
-
-            # write information for each label
-            for label in cluster:
-                
-                # parse info from individual label if needed
-                if consensus_text is None:
-                    found_info = parse_info(label.text)
-                
-                # write label info
-                result_line = format_result_line(label, group_id, found_info,
-                                                 consensus_text=consensus_text)
-                sys.stdout.write(result_line)
-            
-        # remove matched IDs from the list of elements to be sorted
-        match_ids = { label.ID for label in matches }
-        to_be_sorted = [ ID 
-                          for ID in to_be_sorted 
-                          if ID not in match_ids ]
+        # remove matched IDs from the set of elements to be sorted
+        matched_ids = [ label.ID for label in matches ]
+        to_be_sorted.difference_update(matched_ids)
+        to_be_sorted_mask[db.get_positions(matched_ids)] = False
+        yield matches
 
-def sort_by_parsed_info(db, parse_info, format_result_line, 
-                        id_formatter=elieclustering.utils.get_id_formatter("label:5")):
+def get_token_counts(db):
+    '''
+    Returns an integer array with the number of index tokens in each 
+    label of the database. A label cannot score more than its number of
+    tokens divided by the number of query tokens, hence labels with too
+    few tokens can be excluded from a search beforehand.
+    '''
 
-    # store group_ids in a dictionnary, whose keys are parsed information data
-    group_ids = dict()
-    for label in db:
-        found_info = parse_info(label.text)
-        interpeted_data = get_interpreted_data(found_info)
+    return np.fromiter(( len(db.get_item_tokens(ID)) 
+                          for ID in db.get_ids() ), 
+                       dtype=np.intp, count=len(db))
 
-        # try to get an existing group_id (identical parsed information was 
-        # already identified in another label), otherwise create a new group.
-        try:
-            group_id = group_ids[interpeted_data]
-        except KeyError:
-            group_id = id_formatter(len(group_ids))
-            group_ids[interpeted_data] = group_id
+def find_linked_positions(ID, db, min_score, token_counts):
+    '''
+    Search a label against the whole database and returns the positions
+    of the labels that match it with a score greater or equal to 
+    min_score.
+    '''
+
+    seed_tokens = db.get_item_tokens(ID)
+    candidates = token_counts >= min_score*len(seed_tokens) - 1e-9
+    matched_ids = [ label.ID 
+                     for label, score in db.search(db.get(ID).text,
+                                                   candidates=candidates,
+                                                   query_tokens=seed_tokens)
+                     if score >= min_score ]
+    return db.get_positions(matched_ids).tolist()
+
+def init_search_worker(db, min_score, token_counts):
+    '''
+    Build the label search function in a worker process.
+    '''
+
+    global find_label_links
+    find_label_links = partial(find_linked_positions, db=db, 
+                               min_score=min_score, 
+                               token_counts=token_counts)
+
+def search_worker(ID):
+    '''
+    Search a label against the database within a worker process.
+    '''
 
-        # format the result line and print it, this results in an output where
-        # label not ordered by group.
-        result_line = format_result_line(label, group_id, found_info)
-        sys.stdout.write(result_line)
+    return find_label_links(ID)
+
+def get_linked_groups(db, min_score=0.8, jobs=1):
+    '''
+    Aggregate labels by text similarity with single linkage. Every label
+    is searched against the database and linked with the labels that 
+    match it with a score greater or equal to min_score. Groups are the
+    connected components of the resulting graph, returned as lists of 
+    labels in the order of the database.
+    '''
+
+    # searches are independent, they are run either sequentially or by a 
+    # pool of worker processes
+    token_counts = get_token_counts(db)
+    if jobs > 1:
+        pool = elieclustering.utils.get_worker_pool(jobs, init_search_worker, 
+                                                    (db, min_score, 
+                                                     token_counts))
+        links = pool.imap(search_worker, db.get_ids(), chunksize=16)
+    else:
+        pool = None
+        links = map(partial(find_linked_positions, db=db, min_score=min_score,
+                            token_counts=token_counts), 
+                    db.get_ids())
+
+    # store links as a sparse adjacency matrix of the database elements
+    try:
+        rows, cols = [], []
+        for i, positions in enumerate(links):
+            rows += [i]*len(positions)
+            cols += positions
+    finally:
+
+        # stop the worker processes, even if a search failed
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    n = len(db)
+    graph = coo_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), 
+                       shape=(n, n))
+
+    # matches are not symmetric, two labels are linked if any of them 
+    # matches the other
+    n_groups, group_indices = connected_components(graph, directed=True, 
+                                                   connection="weak")
+    groups = defaultdict(list)
+    for label, k in zip(db, group_indices.tolist()):
+        groups[k].append(label)
+    return list(groups.values())
+
+def sort_by_text_similarity(db, parse_info, format_result_line, consensus=None,
+                            min_score=0.8, refine_clustering=False, 
+                            id_formatter=elieclustering.utils.get_id_formatter("label:5"),
+                            quorum=2, early_stop=False, jobs=1, popular_first=False, random_seed=None,
+                            single_linkage=False):
+    '''
+    Aggregate labels by text similarity, then parse information within 
+    label groups.
+    '''
+
+    # with single linkage, all groups are found before they are processed
+    if single_linkage:
+        groups = get_linked_groups(db, min_score=min_score, jobs=jobs)
+    else:
+        groups = iter_similarity_groups(db, min_score=min_score, 
+                                        popular_first=popular_first,
+                                        random_seed=random_seed)
+
+    # Groups are found sequentially, then processed either in the main 
+    # process or by a pool of worker processes. In the latter case, results
+    # are retrieved in the order of the groups.
+    if jobs > 1:
+        pool = elieclustering.utils.get_worker_pool(jobs, init_group_worker, 
+                                                    (parse_info, consensus, 
+                                                     refine_clustering, 
+                                                     quorum, early_stop))
+        group_results = pool.imap(process_group_worker, groups)
+    else:
+        pool = None
+        process_group = get_group_processor(parse_info, consensus=consensus,
+                                            refine_clustering=refine_clustering,
+                                            quorum=quorum, 
+                                            early_stop=early_stop)
+        group_results = ( process_group(matches) for matches in groups )
+
+    try:
+
+        # label group number
+        i = 0
+
+        # print the result, lines are written by batches
+        result_lines = []
+        for results in group_results:
+            for cluster, found_infos, consensus_text in results:
+                i += 1
+                group_id = id_formatter(i)
+
+                # format information for each label
+                result_lines += [ format_result_line(label, group_id, found_info,
+                                                     consensus_text=consensus_text)
+                                   for label, found_info in zip(cluster, 
+                                                                found_infos) ]
+            if len(result_lines) >= WRITE_BATCH_SIZE:
+                sys.stdout.write("".join(result_lines))
+                result_lines.clear()
+        sys.stdout.write("".join(result_lines))
+
+    finally:
+
+        # stop the worker processes, even if the processing or output failed
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def init_parse_worker(parse_info):
+    '''
+    Store the parser function in a worker process.
+    '''
+
+    global parse_label_text
+    parse_label_text = parse_info
+
+def parse_worker(text):
+    '''
+    Parse information from a label text within a worker process.
+    '''
+
+    return parse_label_text(text)
+
+def sort_by_parsed_info(db, parse_info, format_result_line, 
+                        id_formatter=elieclustering.utils.get_id_formatter("label:5"),
+                        jobs=1):
+
+    # Labels are parsed independently, either sequentially or by a pool of 
+    # worker processes. In the latter case, results are retrieved in the 
+    # order of the labels.
+    texts = db.get_texts()
+    if jobs > 1:
+        pool = elieclustering.utils.get_worker_pool(jobs, init_parse_worker, 
+                                                    (parse_info,))
+        found_infos = pool.imap(parse_worker, texts, chunksize=64)
+    else:
+        pool = None
+        found_infos = map(parse_info, texts)
+
+    try:
+
+        # store group_ids in a dictionnary, whose keys are parsed information 
+        # data
+        group_ids = dict()
+        result_lines = []
+        for label, found_info in zip(db, found_infos):
+            interpeted_data = get_interpreted_data(found_info)
+
+            # try to get an existing group_id (identical parsed information 
+            # was already identified in another label), otherwise create a 
+            # new group.
+            try:
+                group_id = group_ids[interpeted_data]
+            except KeyError:
+                group_id = id_formatter(len(group_ids))
+                group_ids[interpeted_data] = group_id
+
+            # format the result line and print it by batches, this results in
+            # an output where label not ordered by group.
+            result_lines.append(format_result_line(label, group_id, 
+                                                   found_info))
+            if len(result_lines) >= WRITE_BATCH_SIZE:
+                sys.stdout.write("".join(result_lines))
+                result_lines.clear()
+        sys.stdout.write("".join(result_lines))
+
+    finally:
+
+        # stop the worker processes, even if the parsing or the output failed
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
 def main(argv=sys.argv):
     
@@ -501,8 +857,8 @@ def main(argv=sys.argv):
     sys.argv[1:] = options.args
     
     # load label data
-    f = StringIO("".join( line for line in fileinput.input() ))
-    db = elieclustering.labeldata.load_labels(f)
+    labels = elieclustering.labeldata.parse_labels(fileinput.input())
+    db = elieclustering.labeldata.LabelDB(list(labels))
     
     # build the index
     min_len = options["min_word_length"]
@@ -515,14 +871,15 @@ def main(argv=sys.argv):
     else:
         collectors = []
 
-    # parser function
-    global parse_info
-    parse_info = partial(parse_info, 
-                         geo=options["geo"], 
-                         date=options["date"],
-                         collectors=collectors)
+    # parser function, bound to a new name so that it can be pickled (with the
+    # collectors) to be sent to worker processes
+    parse = partial(parse_info, 
+                    geo=options["geo"], 
+                    date=options["date"],
+                    collectors=collectors)
 
-    # result line formatter function
+    # result line formatter function, bound to a new name so that the module
+    # function is left unchanged
     fields = []
     if options["geo"]:
         fields.append("geo")
@@ -530,9 +887,7 @@ def main(argv=sys.argv):
         fields.append("date")
     if collectors:
         fields.append("collectors")
-    global format_result_line
-    format_result_line = partial(format_result_line,
-                                 fields=fields)
+    format_line = partial(format_result_line, fields=fields)
 
     # write the header
     header = "label.ID\tlabel.v\tgroup.ID"
@@ -545,17 +900,23 @@ def main(argv=sys.argv):
     
     # sort by using text similarity, then parse info
     if options["sort_by"] == "text_similarity":
-        sort_by_text_similarity(db, parse_info, format_result_line, 
+        sort_by_text_similarity(db, parse, format_line, 
                                 consensus=options["consensus"], 
                                 min_score=options["min_score"],
                                 refine_clustering=options["refine"], 
                                 id_formatter=options["id_formatter"],
-                                quorum=options["quorum"])
+                                quorum=options["quorum"],
+                                early_stop=options["early_stop"],
+                                jobs=options["jobs"],
+                                popular_first=options["popular_first"],
+                                random_seed=options["random_seed"],
+                                single_linkage=options["single_linkage"])
 
     # parse info within label, then aggregate labels containing the same info
     elif options["sort_by"] == "parsed_info":
-        sort_by_parsed_info(db, parse_info, format_result_line, 
-                            id_formatter=options["id_formatter"])
+        sort_by_parsed_info(db, parse, format_line, 
+                            id_formatter=options["id_formatter"],
+                            jobs=options["jobs"])
 
     # returns 0 if everything succeeded
     return 0
@@ -55,8 +55,9 @@ def main(argv=sys.argv):
     with open(db_fname) as f:
         db = json.load(f)
     
-    # load the IDs of the element to be kept
-    id_list = [ line.strip() for line in fileinput.input() ]
+    # load the IDs of the element to be kept, in a set for fast membership
+    # tests
+    id_list = set( line.strip() for line in fileinput.input() )
     
     # subset the DB
     db = [ x for x in db if x["ID"] in id_list ]
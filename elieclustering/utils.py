@@ -3,14 +3,17 @@ This module gathers generic functions for text data handling,
 manipulation and formatting.
 '''
 
-import subprocess
+import subprocess, multiprocessing, sys
 import regex, unicodedata
 import numpy as np
 from kneed import KneeLocator
 from math import log
-from sklearn_extra.cluster import KMedoids
+from operator import itemgetter
+from kmedoids import KMedoids
 from sklearn.metrics import silhouette_score
 from leven import levenshtein
+from rapidfuzz.distance import Levenshtein as RFLevenshtein
+from rapidfuzz.process import cdist
 from nltk import regexp_tokenize, word_tokenize
 
 # =============================================================================
@@ -21,6 +24,24 @@ NURI_pattern = regex.compile(r"(?:http://(?:[\w\s.-]+/)+\s?[\w]+){s<=3}",
                              flags=regex.MULTILINE | regex.V1)
 WS_pattern = regex.compile(r"\s+", flags=regex.MULTILINE)
 
+# =============================================================================
+# CLASSES
+# -----------------------------------------------------------------------------
+class NonSpacingMarkTable(dict):
+    '''
+    Translation table for str.translate, that deletes non-spacing marks 
+    (i.e. accents, once the text is decomposed). Characters are 
+    classified with unicodedata the first time they are encountered, 
+    then looked up in the table.
+    '''
+
+    def __missing__(self, key):
+        value = None if unicodedata.category(chr(key)) == "Mn" else key
+        self[key] = value
+        return value
+
+NSM_table = NonSpacingMarkTable()
+
 # =============================================================================
 # FUNCTIONS
 # -----------------------------------------------------------------------------
@@ -193,17 +214,24 @@ def clear_text(text, ranges, sub=" "):
     '''
     
     if is_range(ranges):
-        ranges = [ranges]
+        r = ranges
+        if type(r) is int:
+            return f"{text[:r]}{sub}{text[r+1:]}"
+        l = (r[1]-r[0])+1
+        return f"{text[:r[0]]}{sub*l}{text[r[1]+1:]}"
+
+    # with several ranges, the characters are replaced in a list, so that the
+    # text is only rebuilt once
+    chars = list(text)
     for r in ranges:
         if type(r) is int:
-            text = f"{text[:r]}{sub}{text[r+1:]}"
+            chars[r:r+1] = sub
         elif len(r) == 2:
             l = (r[1]-r[0])+1
-            mask = sub*l
-            text = f"{text[:r[0]]}{mask}{text[r[1]+1:]}"
+            chars[r[0]:r[1]+1] = sub*l
         else:
             raise ValueError(f"unrecognized range value: {r}")
-    return text
+    return "".join(chars)
 
 def is_range(r):
     '''
@@ -382,8 +410,7 @@ def ngram_dist(a, b):
     for i in range(l):
         a = [ a[i+j-1%l] for j in range(l) ]
         dists = [ levenshtein(x, y) for x, y in zip(a, b) ]
-    dists.sort()
-    return dists[0]
+    return min(dists)
 
 def ngram_search(a, ngrams, mismatch_rule=mismatch_rule):
     '''
@@ -432,12 +459,15 @@ def smoothen_white_spaces(s, pattern=WS_pattern):
 
     return pattern.sub(" ", s.strip())
 
-def strip_accents(s):
+def strip_accents(s, table=NSM_table):
     '''
     Strip accent from a unicode character string.
     '''
-    return ''.join(c for c in unicodedata.normalize('NFKD', s)
-                   if unicodedata.category(c) != 'Mn')
+
+    # ASCII strings do not change with the decomposition
+    if s.isascii():
+        return s
+    return unicodedata.normalize('NFKD', s).translate(table)
 
 def simplify_str(s):
     '''
@@ -446,7 +476,7 @@ def simplify_str(s):
     strip accents.
     '''
 
-    s = smoothen_white_spaces(s)
+    s = " ".join(s.split())
     s = strip_accents(s)
     s = s.lower()
     return s
@@ -492,19 +522,28 @@ def get_pairwise_leven_dist(lines, simplify=False):
 
     '''
     
-    # calculate all possible pairwise distance (avoid diagonal and duplicate 
-    # comparisons)
-    n = len(lines)
-    dist = np.array([ [ get_norm_leven_dist(lines[i], lines[j], simplify=simplify) 
-                          if j < i else 0
-                         for i in range(n) ]
-                         for j in range(n) ])
-    
-    # copy values from the matrix upper triangle to the lower triangle
-    i_lower = np.tril_indices(dist.shape[0], -1)
-    dist[i_lower] = dist.T[i_lower]
+    # each line is simplified once, not for each pair
+    if simplify:
+        lines = [ simplify_str(line) for line in lines ]
+
+    # identical lines are only compared once: distances are calculated 
+    # between unique lines, then expanded to all lines
+    unique_index = dict()
+    inverse = np.array([ unique_index.setdefault(line, len(unique_index)) 
+                          for line in lines ], dtype=np.intp)
+    expand = len(unique_index) < len(lines)
+    if expand:
+        lines = list(unique_index)
+
+    # the whole matrix is calculated by rapidfuzz, which uses a bit-parallel
+    # Levenshtein algorithm and loops over the pairs in C++. Single precision
+    # is enough for distances normalized between 0 and 1.
+    dist = cdist(lines, lines, scorer=RFLevenshtein.normalized_distance,
+                 dtype=np.float32)
     
     # return the pairwise distance matrix
+    if expand:
+        return dist[inverse[:,None], inverse[None,:]]
     return dist
 
 def get_median_dists(dist):
@@ -528,9 +567,10 @@ def get_median_dists(dist):
                          " matrix")
     n = dist.shape[0]
 
-    # calculate median value while ignoring the diagonal values
-    return [ np.median([ dist[i,j] for j in range(n) if i != j ])
-                          for i in range(n) ]
+    # calculate median value while ignoring the diagonal values, which are 
+    # removed to get the n-1 other values of each row
+    off_diagonal = dist[~np.eye(n, dtype=bool)].reshape(n, n-1)
+    return list(np.median(off_diagonal, axis=1))
 
 def get_levenKMedoids(x, n_clusters=8, simplify=False, random_state=12345):
     '''
@@ -570,15 +610,17 @@ def get_levenKMedoids(x, n_clusters=8, simplify=False, random_state=12345):
     if str_input:
         x = get_pairwise_leven_dist(x, simplify=simplify)
         
-    # find n_clusters KMedoids
+    # find n_clusters KMedoids with the FasterPAM algorithm, whose swap
+    # iterations run in O(n^2) regardless of n_clusters
     kmedoids = KMedoids(n_clusters=n_clusters, 
                         metric="precomputed",
-                        init="k-medoids++",
+                        method="fasterpam",
+                        init="build",
                         random_state=random_state).fit(x)
     return (kmedoids, x)
 
 def find_levenKMedoids(lines, max_cluster=8, method="elbow", 
-                       simplify=False, random_state=12345):
+                       simplify=False, random_state=12345, early_stop=False):
     '''
     Optimize clustering of strings given their similarity (expressed as
     Levenshtein distance).
@@ -608,6 +650,15 @@ def find_levenKMedoids(lines, max_cluster=8, method="elbow",
         random_state : int
             A random seed
 
+        early_stop : bool
+            With the elbow method, calculate KMedoids for increasing
+            cluster numbers and stop as soon as the elbow located on 
+            the SSE curve calculated so far is the same for three
+            consecutive cluster numbers, instead of calculating 
+            KMedoids up to max_cluster. This is faster but the elbow 
+            can differ from the one of the complete curve. 
+            Default=False.
+
     '''
     
     # check max_cluster value
@@ -615,8 +666,23 @@ def find_levenKMedoids(lines, max_cluster=8, method="elbow",
         raise ValueError("max_cluster value must be an integer greater than 1")
     
     # calculate KMedoids for 1 to max_cluster cluster numbers
-    kmedoids_results = [ get_levenKMedoids(lines, i, simplify, random_state) 
-                          for i in range(1, max_cluster+1) ]
+    if early_stop and method == "elbow":
+        kmedoids_results = []
+        elbows = []
+        for i in range(1, max_cluster+1):
+            kmedoids_results.append(get_levenKMedoids(lines, i, simplify, 
+                                                      random_state))
+            if i < 3:
+                continue
+            sse = [ kmedoids.inertia_ for kmedoids, dist in kmedoids_results ]
+            elbows.append(KneeLocator(range(i), sse, curve="convex", 
+                                      direction="decreasing").elbow)
+            if (elbows[-1] is not None 
+                and elbows[-3:] == [elbows[-1]]*3):
+                break
+    else:
+        kmedoids_results = [ get_levenKMedoids(lines, i, simplify, random_state) 
+                              for i in range(1, max_cluster+1) ]
     
     # elbow selection
     if method == "elbow":
@@ -626,7 +692,7 @@ def find_levenKMedoids(lines, max_cluster=8, method="elbow",
                 
         # locate the knee, assuming that SSE values are decreasing with increased 
         # cluster number and forming a convex curve
-        kl = KneeLocator(range(max_cluster), sse, curve="convex", 
+        kl = KneeLocator(range(len(sse)), sse, curve="convex", 
                          direction="decreasing")
         
         # best takes the value -1 if the method failed
@@ -803,5 +869,30 @@ def text_pick_consensus(lines, simplify=False):
         lines = [ simplify_str(line) for line in lines ]
     dist = get_pairwise_leven_dist(lines)
     median_dist = get_median_dists(dist)
-    sorted_median_dist = sorted(zip(lines, median_dist), key=lambda x: x[1])
-    return sorted_median_dist[0][0]
+    return min(zip(lines, median_dist), key=itemgetter(1))[0]
+
+def get_worker_pool(jobs, initializer, initargs):
+    '''
+    Start a pool of worker processes. On Linux, workers are forked, so 
+    that they share the data of the main process (databases, collectors,
+    compiled patterns) instead of receiving a pickled copy. Elsewhere, 
+    the platform default start method is used, since forking is unsafe
+    on macOS and unavailable on Windows.
+
+    Parameters
+    ----------
+        jobs : int
+            Number of worker processes.
+
+        initializer : function
+            Function called by each worker process when it starts.
+
+        initargs : tuple
+            Arguments passed to the initializer function.
+    '''
+
+    if sys.platform.startswith("linux"):
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+    return context.Pool(jobs, initializer=initializer, initargs=initargs)